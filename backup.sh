@@ -12,8 +12,9 @@ YELLOW='\033[1;33m'
 NC='\033[0m' # No Color
 
 # Logging function
+# Logs go to stderr so functions whose stdout is captured can still log
 log() {
-    echo -e "${GREEN}[$(date +'%Y-%m-%d %H:%M:%S')]${NC} $1"
+    echo -e "${GREEN}[$(date +'%Y-%m-%d %H:%M:%S')]${NC} $1" >&2
 }
 
 error() {
@@ -27,11 +28,12 @@ warning() {
 # Validate environment variables
 validate_env_vars() {
     local missing_vars=()
-    
-    [[ -z "${SSH_USER:-}" ]] && missing_vars+=("SSH_USER")
-    [[ -z "${SSH_HOST:-}" ]] && missing_vars+=("SSH_HOST")
-    [[ -z "${SSH_PATH:-}" ]] && missing_vars+=("SSH_PATH")
-    
+    local var
+
+    for var in SSH_USER SSH_HOST SSH_PATH; do
+        [[ -z "${!var:-}" ]] && missing_vars+=("$var")
+    done
+
     if [[ ${#missing_vars[@]} -gt 0 ]]; then
         error "Missing required environment variables: ${missing_vars[*]}"
         exit 1
@@ -53,6 +55,42 @@ validate_env_vars() {
         log "Using specified backup destination: $BACKUP_DEST"
     fi
 
+    # Set default archive format if not specified
+    if [[ -z "${BACKUP_FORMAT:-}" ]]; then
+        BACKUP_FORMAT="zip"
+        log "Using default archive format: $BACKUP_FORMAT"
+    elif [[ "$BACKUP_FORMAT" == "zip" || "$BACKUP_FORMAT" == "tar.gz" ]]; then
+        log "Using specified archive format: $BACKUP_FORMAT"
+    else
+        error "Invalid BACKUP_FORMAT: $BACKUP_FORMAT (expected zip or tar.gz)"
+        exit 1
+    fi
+
+    # Set default compression level if not specified
+    # Level 1 keeps the single-threaded deflate on the remote host from gating the backup
+    if [[ -z "${BACKUP_COMPRESSION_LEVEL:-}" ]]; then
+        BACKUP_COMPRESSION_LEVEL="1"
+        log "Using default compression level: $BACKUP_COMPRESSION_LEVEL"
+    elif [[ "$BACKUP_COMPRESSION_LEVEL" =~ ^[0-9]$ ]]; then
+        log "Using specified compression level: $BACKUP_COMPRESSION_LEVEL"
+    else
+        error "Invalid BACKUP_COMPRESSION_LEVEL: $BACKUP_COMPRESSION_LEVEL (expected 0-9)"
+        exit 1
+    fi
+    if [[ "$BACKUP_FORMAT" == "tar.gz" && "$BACKUP_COMPRESSION_LEVEL" == "0" ]]; then
+        error "BACKUP_COMPRESSION_LEVEL 0 is not supported with tar.gz (expected 1-9)"
+        exit 1
+    fi
+
+    # Default to full backups unless incremental mode is requested
+    if [[ -z "${BACKUP_INCREMENTAL:-}" ]]; then
+        BACKUP_INCREMENTAL="false"
+    elif [[ "$BACKUP_INCREMENTAL" != "true" && "$BACKUP_INCREMENTAL" != "false" ]]; then
+        error "Invalid BACKUP_INCREMENTAL: $BACKUP_INCREMENTAL (expected true or false)"
+        exit 1
+    fi
+    log "Incremental backups: $BACKUP_INCREMENTAL"
+
     log "Environment variables validated successfully"
 }
 
@@ -60,30 +98,101 @@ validate_env_vars() {
 create_backup_filename() {
     BACKUP_DATE=$(date +'%Y-%m-%d')
     if [[ -n "${BACKUP_TAG:-}" ]]; then
-        BACKUP_FILENAME="${BACKUP_DATE}.${BACKUP_TAG}.wp-content.zip"
+        BACKUP_FILENAME="${BACKUP_DATE}.${BACKUP_TAG}.wp-content.${BACKUP_FORMAT}"
         DB_BACKUP_FILENAME="${BACKUP_DATE}.${BACKUP_TAG}.database.zip"
+        BACKUP_STATE_FILE=".${BACKUP_TAG}.wp-backup-last"
     else
-        BACKUP_FILENAME="${BACKUP_DATE}.wp-content.zip"
+        BACKUP_FILENAME="${BACKUP_DATE}.wp-content.${BACKUP_FORMAT}"
         DB_BACKUP_FILENAME="${BACKUP_DATE}.database.zip"
+        BACKUP_STATE_FILE=".wp-backup-last"
     fi
+    BACKUP_MODE="full"
     log "Backup filename: $BACKUP_FILENAME"
     log "Database backup filename: $DB_BACKUP_FILENAME"
 }
 
+# Switch to a delta backup when incremental mode is on and a previous backup of the same folders is recorded
+select_backup_mode() {
+    local folder_paths="$1"
+    local previous_folder_paths
+
+    if [[ "$BACKUP_INCREMENTAL" != "true" ]]; then
+        return
+    fi
+
+    # The state file holds the folder list of the backup it marks
+    if ! previous_folder_paths=$(ssh $SSH_OPTS "$SSH_USER@$SSH_HOST" "cat $BACKUP_DEST/$BACKUP_STATE_FILE" 2>/dev/null); then
+        log "No previous backup found, creating a full backup"
+    elif [[ "$previous_folder_paths" != "$folder_paths" ]]; then
+        log "Backup folders changed since the previous backup, creating a full backup"
+    else
+        BACKUP_MODE="delta"
+        BACKUP_FILENAME="${BACKUP_FILENAME%.$BACKUP_FORMAT}.delta.$BACKUP_FORMAT"
+        log "Previous backup found, only files changed since then will be backed up"
+        log "Backup filename: $BACKUP_FILENAME"
+    fi
+}
+
+# Setup SSH options shared by every connection
+setup_ssh_options() {
+    # Move the AEAD ciphers with hardware/vectorised implementations to the front of the default list,
+    # keeping every other default cipher available for hosts that only allow those
+    SSH_OPTS="-o Ciphers=^aes128-gcm@openssh.com,chacha20-poly1305@openssh.com"
+
+    # Archives never cross the connection, only text output such as zip's per-file listing,
+    # so compressing the stream is cheap and pays off on large upload trees
+    SSH_OPTS="$SSH_OPTS -o Compression=yes"
+}
+
 # Setup SSH key if provided
 setup_ssh_key() {
     if [[ -n "${SSH_PUBLIC_KEY:-}" ]]; then
         SSH_KEY_FILE=$(mktemp)
         echo "$SSH_PUBLIC_KEY" > "$SSH_KEY_FILE"
         chmod 600 "$SSH_KEY_FILE"
-        SSH_OPTS="-i $SSH_KEY_FILE"
+        # Offer only this key, skipping ssh-agent and default identity probes
+        SSH_KEY_OPTS="-i $SSH_KEY_FILE -o IdentitiesOnly=yes"
         log "SSH key configured"
     else
-        SSH_OPTS=""
+        SSH_KEY_OPTS=""
         log "Using password authentication"
     fi
 }
 
+# Open one authenticated master connection that every later ssh call multiplexes over
+start_ssh_master() {
+    local master_opts
+
+    if [[ -n "${SSH_CONTROL_PERSIST:-}" ]]; then
+        # Keep the master alive after exit so later runs against the same host skip the handshake
+        mkdir -p -m 700 "$HOME/.ssh"
+        SSH_OPTS="$SSH_OPTS -o ControlPath=$HOME/.ssh/wp-backup-%C"
+        # auto unlinks a stale socket left by a master that died or a reboot before taking its place
+        master_opts="-o ControlMaster=auto -o ControlPersist=$SSH_CONTROL_PERSIST"
+    else
+        # A short fixed prefix keeps the socket path under the 104-byte limit on macOS, where $TMPDIR is long
+        SSH_CONTROL_DIR=$(mktemp -d /tmp/wpb.XXXXXX)
+        SSH_OPTS="$SSH_OPTS -o ControlPath=$SSH_CONTROL_DIR/%C"
+        master_opts="-o ControlMaster=yes"
+    fi
+
+    if [[ -n "${SSH_CONTROL_PERSIST:-}" ]] && ssh $SSH_OPTS -O check "$SSH_USER@$SSH_HOST" 2>/dev/null; then
+        log "Reusing shared SSH connection"
+    else
+        log "Opening shared SSH connection..."
+        if ! ssh $SSH_OPTS $SSH_KEY_OPTS $master_opts -f -N "$SSH_USER@$SSH_HOST"; then
+            error "Failed to connect to $SSH_USER@$SSH_HOST"
+            cleanup_and_exit 1
+        fi
+    fi
+
+    # Only the master authenticates, so the key no longer needs to sit on disk
+    if [[ -n "${SSH_KEY_FILE:-}" ]] && [[ -f "$SSH_KEY_FILE" ]]; then
+        rm -f "$SSH_KEY_FILE"
+        log "Temporary SSH key file cleaned up"
+    fi
+}
+
 # Build folder paths from WP_BACKUP_INCLUDE_ONLY_FOLDERS
 build_folder_paths() {
     local folder_paths=""
@@ -130,46 +239,100 @@ verify_backup_destination() {
     echo "$remote_abs_path"
 }
 
-# Create zip backup on remote server
-create_zip_backup() {
+# Create backup archive on remote server
+create_archive_backup() {
     local folder_paths="$1"
     local remote_abs_path="$2"
 
-    # Create zip command for specified wp-content folders in the destination directory
+    # Only files modified or created since the last backup, plus the always-included files
+    # ctime also catches files copied in with their original mtime preserved (rsync -a, cp -p, tar x)
+    # Renaming or moving a directory only updates its own ctime, so such directories (new ctime but
+    # unchanged entries, hence an old mtime) contribute their whole subtree
+    local changed_files="{ find $folder_paths -type f \
+        \\( -newer $BACKUP_DEST/$BACKUP_STATE_FILE -o -cnewer $BACKUP_DEST/$BACKUP_STATE_FILE \\); \
+        find $folder_paths -type d -cnewer $BACKUP_DEST/$BACKUP_STATE_FILE ! -newer $BACKUP_DEST/$BACKUP_STATE_FILE \
+        -exec find {} -type f \\; ; } | sort -u; \
+        printf '%s\n' wp-config.php wp-includes/version.php"
+
+    # Already-compressed media is stored as-is by zip instead of being deflated again
+    # zip matches suffixes case-sensitively, and camera uploads keep names like IMG_0001.JPG
+    local zip_store_suffixes=".jpg:.jpeg:.png:.gif:.webp:.avif:.mp4:.mov:.webm:.mp3:.m4a:.pdf:.woff2:.zip:.gz:.7z"
+    zip_store_suffixes="$zip_store_suffixes:.JPG:.JPEG:.PNG:.GIF:.WEBP:.AVIF:.MP4:.MOV:.WEBM:.MP3:.M4A:.PDF:.WOFF2:.ZIP:.GZ:.7Z"
+
+    # Create archive command for specified wp-content folders in the destination directory
     # The backup path expansion happens on the remote server
-    local zip_command="cd $SSH_PATH && zip -r $BACKUP_DEST/$BACKUP_FILENAME \
+    local archive_command
+    if [[ "$BACKUP_FORMAT" == "tar.gz" ]]; then
+        local tar_excludes="--exclude='wp-content/cache/*' --exclude='wp-content/tmp/*'"
+        local tar_paths=""
+        local tar_command
+        if [[ "$BACKUP_MODE" == "delta" ]]; then
+            tar_command="{ $changed_files; } | tar $tar_excludes -cf - -T -"
+        else
+            # Skip paths missing on this site with a warning, as zip does, instead of letting tar fail
+            # An empty list still fails the backup, like zip's "Nothing to do!"
+            tar_paths="set -- && for path in $folder_paths wp-config.php wp-includes/version.php; do \
+        if [ -e \"\$path\" ]; then set -- \"\$@\" \"\$path\"; \
+        else echo \"tar warning: name not matched: \$path\" >&2; fi; \
+        done && [ \$# -gt 0 ] && "
+            tar_command="tar $tar_excludes -cf - \"\$@\""
+        fi
+        # pigz compresses on every remote core, gzip is the single-threaded fallback
+        # The redirection always creates the file, so a failed tar (exit status 2; 1 only means
+        # files changed while being read) must fail the pipeline and remove the partial archive
+        archive_command="${tar_paths}set -o pipefail && { $tar_command; [ \$? -le 1 ]; } \
+        | \$(command -v pigz || echo gzip) -$BACKUP_COMPRESSION_LEVEL > $BACKUP_DEST/$BACKUP_FILENAME \
+        || { rm -f $BACKUP_DEST/$BACKUP_FILENAME; false; }"
+    elif [[ "$BACKUP_MODE" == "delta" ]]; then
+        archive_command="{ $changed_files; } \
+        | zip -$BACKUP_COMPRESSION_LEVEL -n $zip_store_suffixes -@ $BACKUP_DEST/$BACKUP_FILENAME \
+        -x 'wp-content/cache/*' 'wp-content/tmp/*' \
+        || echo 'Some files may have been skipped due to permissions'"
+    else
+        archive_command="zip -r -$BACKUP_COMPRESSION_LEVEL -n $zip_store_suffixes $BACKUP_DEST/$BACKUP_FILENAME \
         $folder_paths \
         wp-config.php \
         wp-includes/version.php \
         -x 'wp-content/cache/*' 'wp-content/tmp/*' \
         || echo 'Some files may have been skipped due to permissions'"
+    fi
 
-    if ssh $SSH_OPTS "$SSH_USER@$SSH_HOST" "$zip_command"; then
-        verify_backup_created "$remote_abs_path"
-    else
+    # The existence check runs in the same session so it costs no extra round trip
+    local backup_command="{ cd $SSH_PATH && $archive_command; } \
+        && test -f $BACKUP_DEST/$BACKUP_FILENAME"
+
+    # Record this backup and its folder list as the baseline for the next incremental run
+    # The timestamp is taken before the walk so files changed while archiving are picked up next time
+    if [[ "$BACKUP_INCREMENTAL" == "true" ]]; then
+        backup_command="printf '%s\n' '$folder_paths' > $BACKUP_DEST/$BACKUP_STATE_FILE.new \
+        && $backup_command \
+        && mv -f $BACKUP_DEST/$BACKUP_STATE_FILE.new $BACKUP_DEST/$BACKUP_STATE_FILE"
+    fi
+
+    if ssh $SSH_OPTS "$SSH_USER@$SSH_HOST" "$backup_command"; then
+        report_backup_location "$remote_abs_path"
+    elif [[ $? -eq 255 ]]; then
+        # ssh exits with 255 when the connection itself fails
         error "Failed to create backup on remote server"
         cleanup_and_exit 1
+    else
+        error "Backup file was not created on remote server"
+        cleanup_and_exit 1
     fi
 }
 
-# Verify backup file was created successfully
-verify_backup_created() {
+# Report the location of the backup file created on the remote server
+report_backup_location() {
     local remote_abs_path="$1"
 
     # Extract just the directory path from the verification output
     local backup_dir=$(echo "$remote_abs_path" | head -n1)
     local full_backup_path="${backup_dir}/${BACKUP_FILENAME}"
 
-    # Check if the backup was actually created
-    if ssh $SSH_OPTS "$SSH_USER@$SSH_HOST" "test -f $BACKUP_DEST/$BACKUP_FILENAME"; then
-        log "Backup created successfully"
-        echo ""
-        echo -e "${GREEN}Backup file location:${NC} $SSH_USER@$SSH_HOST:$full_backup_path"
-        echo ""
-    else
-        error "Backup file was not created on remote server"
-        cleanup_and_exit 1
-    fi
+    log "Backup created successfully"
+    echo ""
+    echo -e "${GREEN}Backup file location:${NC} $SSH_USER@$SSH_HOST:$full_backup_path"
+    echo ""
 }
 
 # Create backup on remote server
@@ -177,16 +340,21 @@ create_remote_backup() {
     log "Creating backup on remote server..."
 
     # Build folder paths
-    local folder_paths=$(build_folder_paths)
+    local folder_paths
+    folder_paths=$(build_folder_paths) || cleanup_and_exit 1
+
+    # Decide between a full and a delta backup
+    select_backup_mode "$folder_paths"
 
     # Ensure backup destination exists
     ensure_remote_backup_directory
 
     # Verify backup destination path
-    local remote_abs_path=$(verify_backup_destination)
+    local remote_abs_path
+    remote_abs_path=$(verify_backup_destination) || cleanup_and_exit 1
 
-    # Create the zip backup
-    create_zip_backup "$folder_paths" "$remote_abs_path"
+    # Create the backup archive
+    create_archive_backup "$folder_paths" "$remote_abs_path"
 }
 
 
@@ -194,8 +362,7 @@ create_remote_backup() {
 cleanup_remote_test_file() {
     if [[ -n "${BACKUP_FILENAME:-}" ]]; then
         local test_file="${BACKUP_FILENAME}.location.txt"
-        if ssh $SSH_OPTS "$SSH_USER@$SSH_HOST" "test -f $BACKUP_DEST/$test_file" 2>/dev/null; then
-            ssh $SSH_OPTS "$SSH_USER@$SSH_HOST" "rm -f $BACKUP_DEST/$test_file" 2>/dev/null || true
+        if ssh $SSH_OPTS "$SSH_USER@$SSH_HOST" "test -f $BACKUP_DEST/$test_file && rm -f $BACKUP_DEST/$test_file" 2>/dev/null; then
             log "Remote test file cleaned up"
         fi
     fi
@@ -205,6 +372,14 @@ cleanup_remote_test_file() {
 cleanup_and_exit() {
     local exit_code=${1:-0}
 
+    # Close the shared SSH connection unless it is meant to persist
+    # Only the top-level shell owns it; helpers run through $(...) must not tear it down
+    if [[ $BASH_SUBSHELL -eq 0 ]] && [[ -n "${SSH_CONTROL_DIR:-}" ]] && [[ -d "$SSH_CONTROL_DIR" ]]; then
+        ssh $SSH_OPTS -O exit "$SSH_USER@$SSH_HOST" 2>/dev/null || true
+        rm -rf "$SSH_CONTROL_DIR"
+        log "Shared SSH connection closed"
+    fi
+
     # Clean up temporary SSH key file
     if [[ -n "${SSH_KEY_FILE:-}" ]] && [[ -f "$SSH_KEY_FILE" ]]; then
         rm -f "$SSH_KEY_FILE"
@@ -224,12 +399,16 @@ main() {
     # Create backup filename
     create_backup_filename
     
-    # Setup SSH key
+    # Setup SSH options and key
+    setup_ssh_options
     setup_ssh_key
     
     # Trap to ensure cleanup on exit
     trap 'cleanup_and_exit $?' EXIT
-    
+
+    # Connect once and reuse the connection for every remote step
+    start_ssh_master
+
     # Create backup on remote server
     create_remote_backup
 